@@ -1,17 +1,69 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
 import os
-from datetime import datetime
 import calendar
+import csv
+import hashlib
+import json
+import re
+from collections import namedtuple
+
+# Directory (relative to the data root) holding the Parquet snapshot of the
+# prepared data and the manifest of the CSVs it was built from
+CACHE_DIR = '.cache'
+SNAPSHOT_FILE = 'combined.parquet'
+MANIFEST_FILE = 'manifest.json'
+# Schema version of the prepared frame, recorded with every snapshot. Bump it
+# whenever the loader changes the frame's columns or dtypes, so a snapshot
+# written by an older loader is rebuilt instead of being served.
+SNAPSHOT_VERSION = 11
+# Per-key snapshots (<md5>.parquet) written by the earlier cache layout
+LEGACY_SNAPSHOT_RE = re.compile(r'^[0-9a-f]{32}\.parquet$')
+
+# Data layout: year folders (e.g. 2024) holding one YYYY-MON.csv file per month
+YEAR_DIR_RE = re.compile(r'^\d{4}$')
+CSV_FILE_RE = re.compile(r'^(\d{4})-([A-Z]{3})\.csv$', re.IGNORECASE)
+# Locale-independent lookup of the month abbreviations used in file names
+MONTH_MAP = {
+    m: i for i, m in enumerate(
+        ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC'], start=1
+    )
+}
+
+# Only these columns are read from each CSV, with explicit types so the
+# reader skips inference. Registration counts are small integers, hence int32.
+VEHICLE_CATEGORIES = ['2W', '3W', '4W']
+CSV_SCHEMA = pa.schema([('Maker', pa.string())] + [(c, pa.int32()) for c in VEHICLE_CATEGORIES])
+CSV_FORMAT = ds.CsvFileFormat(
+    convert_options=pacsv.ConvertOptions(column_types=dict(zip(CSV_SCHEMA.names, CSV_SCHEMA.types)))
+)
+
+# The caches keyed on sidebar selections are process-wide, so each keeps only
+# this many filter states instead of every combination any session has tried
+SELECTION_CACHE_ENTRIES = 64
+
+# Plotly.js options shared by every chart; the logo link is dropped from the modebar
+PLOTLY_CONFIG = {'responsive': True, 'displaylogo': False}
 
 # --- Page Configuration ---
 # Set the layout to wide for a more spacious dashboard
 st.set_page_config(layout="wide")
 
+# Prepared data plus the summaries the sidebar widgets need, computed once per load
+DashboardData = namedtuple(
+    'DashboardData',
+    ['df', 'data_version', 'registrations_by_month', 'makers_sorted', 'categories_sorted', 'top10_makers', 'years', 'yoy_years', 'year_min', 'year_max']
+)
+
 # --- Data Loading and Caching ---
-@st.cache_data
-def load_and_prepare_data(base_path):
+def read_registration_data(base_path):
     """
     Loads vehicle registration data from a directory structure (year/month.csv),
     processes it, and returns a clean DataFrame.
@@ -22,30 +74,26 @@ def load_and_prepare_data(base_path):
     Returns:
         pandas.DataFrame: A cleaned and prepared DataFrame with all data.
     """
-    all_data = []
-    
     # --- REAL DATA LOADING ---
     st.info(f"Searching for data in subdirectories of: {os.path.abspath(base_path)}")
     
-    found_files_log = []
+    # Only year folders are scanned, and file names are matched against
+    # YYYY-MON.csv directly instead of walking the whole tree.
+    csv_files = {}
     try:
-        for root, _, files in os.walk(base_path):
-            for file in files:
-                if file.endswith('.csv') and '-' in file:
-                    found_files_log.append(os.path.join(root, file))
-                    try:
-                        year_str, month_str = file.replace('.csv', '').split('-')
-                        if os.path.basename(root) == year_str:
-                            month = datetime.strptime(month_str.upper(), "%b").month
-                            file_path = os.path.join(root, file)
-                            df = pd.read_csv(file_path)
-                            df['year'] = int(year_str)
-                            df['month'] = month
-                            all_data.append(df)
-                    except ValueError:
-                        st.warning(f"Skipping file with unexpected name format: {file}")
-                    except Exception as e:
-                        st.error(f"Error processing file {file}: {e}")
+        with os.scandir(base_path) as year_dirs:
+            for year_dir in year_dirs:
+                if not (year_dir.is_dir() and YEAR_DIR_RE.match(year_dir.name)):
+                    continue
+                with os.scandir(year_dir.path) as entries:
+                    for entry in entries:
+                        match = CSV_FILE_RE.match(entry.name)
+                        if match:
+                            if match.group(1) == year_dir.name:
+                                csv_files[entry.path] = (match.group(1), match.group(2))
+                        elif entry.name.endswith('.csv'):
+                            st.warning(f"Skipping file with unexpected name format: {entry.name}")
+        found_files_log = sorted(csv_files)
     except Exception as e:
         st.error(f"Could not read data directories. Error: {e}")
         return pd.DataFrame()
@@ -56,39 +104,425 @@ def load_and_prepare_data(base_path):
         else:
             st.write("No CSV files found. Check your folder structure.")
 
-    if not all_data:
+    # --- Parquet Snapshot ---
+    # The prepared frame is persisted to a single Parquet snapshot alongside a
+    # manifest of the CSVs' relative paths and mtimes. A fresh session reads the
+    # snapshot directly when the manifest still matches the files on disk.
+    cache_dir = os.path.join(base_path, CACHE_DIR)
+    snapshot_path = os.path.join(cache_dir, SNAPSHOT_FILE)
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'files': {os.path.relpath(p, base_path): os.path.getmtime(p) for p in found_files_log},
+    }
+    if found_files_log and os.path.exists(snapshot_path) and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                if json.load(f) == manifest:
+                    return pd.read_parquet(snapshot_path, engine="pyarrow")
+        except Exception as e:
+            st.warning(f"Could not read cached data, rebuilding from CSV files. Error: {e}")
+
+    # Year and month come from the file name; the CSVs themselves are read in a
+    # single batched pyarrow scan rather than one pd.read_csv call per file.
+    file_periods = {}
+    for file_path in found_files_log:
+        year_str, month_str = csv_files[file_path]
+        month = MONTH_MAP.get(month_str.upper())
+        if month is None:
+            st.warning(f"Skipping file with unexpected name format: {os.path.basename(file_path)}")
+            continue
+        # Only the header line is read here. Files that are empty or have no
+        # Maker column are skipped, as the scan can't use them. A missing count
+        # column keeps the file: the scan fills it with nulls, counted as zero.
+        try:
+            with open(file_path, newline='', encoding='utf-8-sig') as f:
+                header = next(csv.reader(f), [])
+        except Exception as e:
+            st.warning(f"Skipping unreadable file {os.path.basename(file_path)}. Error: {e}")
+            continue
+        if 'Maker' not in header:
+            st.warning(f"Skipping file {os.path.basename(file_path)}: it is empty or has no Maker column.")
+            continue
+        missing_columns = [c for c in VEHICLE_CATEGORIES if c not in header]
+        if missing_columns:
+            st.warning(f"File {os.path.basename(file_path)} has no {', '.join(missing_columns)} column(s); they are treated as empty.")
+        file_periods[file_path] = (int(year_str), month)
+
+    if not file_periods:
         st.warning("No data files were loaded. Please ensure your '2023', '2024', and '2025' folders with correctly named CSV files exist in the same directory as your script.")
         return pd.DataFrame()
 
-    combined_df = pd.concat(all_data, ignore_index=True)
+    scan_columns = [*CSV_SCHEMA.names, '__filename']
+    try:
+        dataset = ds.dataset(list(file_periods), schema=CSV_SCHEMA, format=CSV_FORMAT)
+    except Exception as e:
+        st.error(f"Error processing data files: {e}")
+        return pd.DataFrame()
+    # The scan reports each row's file as the filesystem-normalised path (e.g.
+    # forward slashes on Windows), so key the periods on dataset.files, which
+    # keeps the input order, rather than on the os.scandir paths.
+    periods_by_file = dict(zip(dataset.files, file_periods.values()))
+    try:
+        # Read every file concurrently (default readahead is only 4 files);
+        # the CSV parsing itself runs on Arrow's thread pool.
+        table = dataset.to_table(
+            columns=scan_columns,
+            use_threads=True,
+            fragment_readahead=min(32, len(file_periods))
+        )
+    except Exception:
+        # One malformed file fails the whole scan, so fall back to reading the
+        # files one at a time and skip only the ones that can't be parsed
+        tables = []
+        for fragment in dataset.get_fragments():
+            try:
+                tables.append(fragment.to_table(schema=CSV_SCHEMA, columns=scan_columns))
+            except Exception as e:
+                st.error(f"Error processing file {os.path.basename(fragment.path)}: {e}")
+        if not tables:
+            st.error("Error processing data files: none of the CSV files could be read.")
+            return pd.DataFrame()
+        table = pa.concat_tables(tables)
+
+    # Dictionary-encode the source file of each row, then gather year and
+    # month from per-file lookup arrays instead of mapping every row's path.
+    source_files = table.column('__filename').dictionary_encode().combine_chunks()
+    file_index = source_files.indices.to_numpy()
+    periods = np.array([periods_by_file[p] for p in source_files.dictionary.to_pylist()], dtype='int64')
+
+    combined_df = table.drop_columns('__filename').to_pandas(types_mapper=pd.ArrowDtype)
+    makers = combined_df['Maker'].astype('category')
+    maker_codes = makers.cat.codes.to_numpy()
+    year_arr = periods[file_index, 0].astype('int16')
+    month_arr = periods[file_index, 1].astype('int8')
+
+    # Wide to long, column by column: for each vehicle category keep only the
+    # rows with registrations, so zero counts are never materialised.
+    keep_masks, counts = [], []
+    for category in VEHICLE_CATEGORIES:
+        values = combined_df[category].to_numpy('int32', na_value=0)
+        keep = values > 0
+        keep_masks.append(keep)
+        counts.append(values[keep])
+
+    melted_df = pd.DataFrame({
+        'Maker': pd.Categorical.from_codes(
+            np.concatenate([maker_codes[keep] for keep in keep_masks]), makers.cat.categories
+        ),
+        'year': np.concatenate([year_arr[keep] for keep in keep_masks]),
+        'month': np.concatenate([month_arr[keep] for keep in keep_masks]),
+        'Vehicle Category': pd.Categorical.from_codes(
+            np.repeat(np.arange(len(VEHICLE_CATEGORIES), dtype='int8'), [len(c) for c in counts]),
+            VEHICLE_CATEGORIES
+        ),
+        'Registrations': np.concatenate(counts),
+    })
+
+    # Dates come straight from a months-since-epoch integer array
+    months = melted_df['month'].to_numpy('int64') - 1
+    months_since_epoch = (melted_df['year'].to_numpy('int64') - 1970) * 12 + months
+    melted_df['Date'] = months_since_epoch.astype('datetime64[M]').astype('datetime64[ns]')
+    melted_df['QuarterValue'] = (months // 3 + 1).astype('int8')
+
+    # Roll up to one row per maker, category and month so every downstream
+    # filter and groupby scans the smallest possible frame.
+    melted_df = melted_df.groupby(
+        ['year', 'month', 'Date', 'QuarterValue', 'Maker', 'Vehicle Category'],
+        observed=True, sort=False, as_index=False
+    )['Registrations'].sum()
+    # Months since year 0, so neighbouring months are plain integer offsets
+    melted_df['YearMonth'] = melted_df['year'].astype('int32') * 12 + (melted_df['month'].astype('int32') - 1)
+    # Likewise quarters since year 0: the previous quarter is QCode - 1 and the
+    # same quarter a year earlier is QCode - 4
+    melted_df['QCode'] = melted_df['year'].astype('int32') * 4 + (melted_df['QuarterValue'].astype('int32') - 1)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        melted_df.to_parquet(snapshot_path, engine="pyarrow", compression="zstd")
+        # Written last, so an interrupted write never pairs a stale snapshot
+        # with a matching manifest
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        # The single snapshot supersedes any hash-named files left behind
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if LEGACY_SNAPSHOT_RE.match(entry.name):
+                    os.remove(entry.path)
+    except Exception as e:
+        st.warning(f"Could not write data cache. Error: {e}")
+
+    return melted_df
+
+@st.cache_resource
+def load_and_prepare_data(base_path):
+    """
+    Loads the prepared registration data and precomputes the option lists and
+    defaults used by the sidebar, so reruns don't rescan the full dataset.
 
-    melted_df = combined_df.melt(
-        id_vars=['Maker', 'year', 'month'],
-        value_vars=['2W', '3W', '4W'],
-        var_name='Vehicle Category',
-        value_name='Registrations'
+    The result is a single object shared by every session on the server (no
+    per-call copy), so callers must treat it as read-only: filter into new
+    frames, never modify the DataFrame or Series in place.
+
+    Args:
+        base_path (str): The path to the root directory containing year folders.
+
+    Returns:
+        DashboardData: The prepared DataFrame, a content hash identifying it
+        (used in the cache keys of the functions below), its registrations
+        indexed by (YearMonth, Maker, Vehicle Category) for month lookups, its
+        sorted makers, categories and years, the years that have a previous
+        year of data (for YoY), the top 10 makers by registrations and the
+        year range.
+    """
+    df = read_registration_data(base_path)
+    if df.empty:
+        return DashboardData(df, None, pd.Series(dtype='int32'), [], [], [], [], [], None, None)
+
+    years = sorted(df['year'].unique().tolist())
+    year_set = set(years)
+
+    return DashboardData(
+        df=df,
+        data_version=hashlib.md5(pd.util.hash_pandas_object(df).to_numpy().tobytes()).hexdigest(),
+        registrations_by_month=df.set_index(['YearMonth', 'Maker', 'Vehicle Category'])['Registrations'].sort_index(),
+        makers_sorted=sorted(df['Maker'].unique()),
+        categories_sorted=sorted(df['Vehicle Category'].unique()),
+        top10_makers=top_n(df.groupby('Maker', observed=True, sort=False)['Registrations'].sum(), 10).index.tolist(),
+        years=years,
+        yoy_years=[y for y in years if y - 1 in year_set],
+        year_min=int(df['year'].min()),
+        year_max=int(df['year'].max()),
     )
 
-    melted_df = melted_df[melted_df['Registrations'] > 0]
-    melted_df['Date'] = pd.to_datetime(melted_df[['year', 'month']].assign(day=1))
-    melted_df['QuarterValue'] = melted_df['Date'].dt.quarter
-    melted_df['Quarter'] = "Q" + melted_df['Date'].dt.quarter.astype(str)
+# --- Helper function to pick the largest totals ---
+def top_n(series, n):
+    """
+    Returns the `n` largest values of a numeric Series, largest first.
+    np.argpartition selects them in linear time, so only those `n` are sorted.
+    """
+    if len(series) <= n:
+        return series.sort_values(ascending=False, kind='stable')
+    top = np.argpartition(series.to_numpy(), -n)[-n:]
+    return series.iloc[top].sort_values(ascending=False, kind='stable')
+
+# --- Helper function to filter categorical columns ---
+def categorical_mask(series, values):
+    """
+    Returns a boolean mask of the rows of a categorical Series whose value is
+    in `values`, via a per-category lookup table indexed by the row codes.
+    """
+    categories = series.cat.categories
+    # One extra False slot so missing values (code -1) never match
+    lookup = np.zeros(len(categories) + 1, dtype=bool)
+    positions = categories.get_indexer(values)
+    lookup[positions[positions >= 0]] = True
+    return lookup[series.cat.codes.to_numpy()]
+
+# --- Filtering and Aggregation ---
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def compute_aggregates(_data, data_version, years, categories, makers, month=None):
+    """
+    Filters the data to the sidebar selections and computes the totals used by
+    the metrics and charts. Cached on the selections, so returning to a
+    previously seen filter state is instant.
 
+    Args:
+        _data (pandas.DataFrame): The prepared registration data. Not hashed;
+            `data_version` stands in for it in the cache key.
+        data_version (str): Content hash of `_data` from DashboardData.
+        years (tuple): Inclusive (first, last) year range.
+        categories (tuple): Selected vehicle categories.
+        makers (tuple): Selected manufacturers.
+        month (int, optional): Restrict to this month number (Monthly view).
 
-    return melted_df
+    Returns:
+        dict: The filtered frame ('filtered'), its (Date, QuarterValue, QCode,
+        Maker, Vehicle Category) sums ('agg') and the totals per month
+        ('monthly'), maker ('maker'), vehicle category ('category'), quarter
+        label ('quarter') and calendar quarter code ('quarter_code').
+    """
+    # Build one boolean mask in place; the categorical columns are matched on
+    # their integer codes rather than on strings.
+    year_arr = _data['year'].to_numpy()
+    mask = year_arr >= years[0]
+    mask &= year_arr <= years[1]
+    mask &= categorical_mask(_data['Vehicle Category'], categories)
+    mask &= categorical_mask(_data['Maker'], makers)
+    if month is not None:
+        mask &= _data['month'].to_numpy() == month
+    # Positional take of the surviving rows: a single gather per column
+    filtered = _data.take(np.flatnonzero(mask))
+
+    # One groupby over the filtered frame; the per-chart totals are derived
+    # from it by summing along index levels.
+    agg = filtered.groupby(
+        ['Date', 'QuarterValue', 'QCode', 'Maker', 'Vehicle Category'], observed=True, sort=False
+    )['Registrations'].sum()
+
+    monthly = agg.groupby(level='Date').sum()
+    # Quarters are grouped on their int8 number and only labelled ('Q1'...)
+    # once summed down to at most four rows
+    quarterly = agg.groupby(level='QuarterValue').sum()
+    quarterly.index = ("Q" + quarterly.index.astype(str)).rename('Quarter')
+
+    return {
+        'filtered': filtered,
+        'agg': agg,
+        'monthly': monthly,
+        'maker': agg.groupby(level='Maker', observed=True, sort=False).sum(),
+        'category': agg.groupby(level='Vehicle Category', observed=True).sum(),
+        'quarter': quarterly,
+        'quarter_code': agg.groupby(level='QCode').sum(),
+    }
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def compute_monthly_kpis(_dashboard_data, data_version, year, month, categories, makers):
+    """
+    Computes the Monthly view's metrics from the month-indexed registrations.
+    Cached on the selections; `data_version` identifies `_dashboard_data`,
+    which is not hashed.
+
+    Returns:
+        tuple: Total registrations for the month, MoM growth (%) and YoY growth (%).
+    """
+    registrations = _dashboard_data.registrations_by_month
+    current_ym = year * 12 + (month - 1)
+
+    current_registrations = month_selection_total(registrations, current_ym, categories, makers)
+    prev_month_registrations = month_selection_total(registrations, current_ym - 1, categories, makers)
+    prev_year_registrations = month_selection_total(registrations, current_ym - 12, categories, makers)
+
+    mom_growth = ((current_registrations - prev_month_registrations) / prev_month_registrations) * 100 if prev_month_registrations else 0
+    yoy_growth = ((current_registrations - prev_year_registrations) / prev_year_registrations) * 100 if prev_year_registrations else 0
+    return current_registrations, mom_growth, yoy_growth
+
+# --- Helper function to total one month of the indexed registrations ---
+def month_selection_total(registrations_by_month, year_month, categories, makers):
+    """
+    Sums the registrations of a single YearMonth over the selected vehicle
+    categories and makers, or returns 0 when that month has no data.
+    """
+    try:
+        month_registrations = registrations_by_month.xs(year_month, level='YearMonth')
+    except KeyError:
+        return 0
+    selected = (
+        month_registrations.index.get_level_values('Vehicle Category').isin(categories) &
+        month_registrations.index.get_level_values('Maker').isin(makers)
+    )
+    # Summed on the raw array, so no filtered Series is built per lookup
+    return int(month_registrations.to_numpy()[selected].sum())
+
+# --- Chart Builders ---
+# Columns are handed to Plotly as NumPy arrays, which skips its DataFrame
+# introspection. The plotly.express figures are cached on their (small) input
+# frames; the graph_objects ones are cheaper to rebuild than to unpickle, since
+# unpickling a figure re-validates it through its constructor.
+# Each figure also keeps a fixed uirevision so Plotly.js updates it in place
+# (keeping zoom and legend state) instead of redrawing it on every rerun.
+def build_trends_fig(trends, x, title, x_label):
+    """Bar chart of total registrations per `x` (Date or Quarter)."""
+    # A single go.Bar trace skips plotly.express's per-trace frame handling
+    fig = go.Figure(go.Bar(
+        x=trends[x].to_numpy(),
+        y=trends['Registrations'].to_numpy(),
+        hovertemplate=f'{x_label}=%{{x}}<br>Number of Registrations=%{{y}}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=title,
+        xaxis_title=x_label,
+        yaxis_title='Number of Registrations',
+        title_x=0.5,
+        uirevision=f'trend-{x}'
+    )
+    return fig
+
+def build_share_fig(manufacturer_share):
+    """Pie chart of registrations by manufacturer."""
+    fig = go.Figure(go.Pie(
+        labels=manufacturer_share['Maker'].to_numpy(),
+        values=manufacturer_share['Registrations'].to_numpy(),
+        hovertemplate='Maker=%{label}<br>Registrations=%{value}<extra></extra>'
+    ))
+    fig.update_layout(title='Top 10 Manufacturers', title_x=0.5, uirevision='share')
+    return fig
+
+def build_category_fig(category_share):
+    """Bar chart of registrations by vehicle category."""
+    # One colour per category from the active template's colorway. Inside
+    # Streamlit that is the "streamlit" template, whose placeholder colours the
+    # frontend maps to the app theme, as it does for the plotly.express charts.
+    palette = pio.templates[pio.templates.default].layout.colorway or px.colors.qualitative.Plotly
+    fig = go.Figure(go.Bar(
+        x=category_share['Vehicle Category'].to_numpy(),
+        y=category_share['Registrations'].to_numpy(),
+        marker_color=[palette[i % len(palette)] for i in range(len(category_share))],
+        hovertemplate='Vehicle Category=%{x}<br>Registrations=%{y}<extra></extra>'
+    ))
+    fig.update_layout(
+        title='Registrations by Vehicle Category',
+        xaxis_title='Vehicle Category',
+        yaxis_title='Registrations',
+        title_x=0.5,
+        uirevision='category'
+    )
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def build_leaderboard_fig(leader_board, leader_category):
+    """Horizontal bar chart ranking manufacturers within one category."""
+    fig = px.bar(
+        x=leader_board['Registrations'].to_numpy(),
+        y=leader_board['Maker'].to_numpy(),
+        orientation='h',
+        title=f'Rankings in {leader_category}',
+        labels={'x': 'Total Registrations', 'y': 'Manufacturer'}
+    )
+    fig.update_layout(
+        yaxis={'categoryorder':'total ascending'},
+        title_x=0.5,
+        uirevision='leaderboard'
+    )
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def build_yoy_growth_fig(growth, title):
+    """Horizontal bar chart of YoY growth (%) per manufacturer."""
+    growth_pct = growth['YoY_Growth_%'].to_numpy()
+    fig = px.bar(
+        x=growth_pct,
+        y=growth['Maker'].to_numpy(),
+        orientation='h',
+        title=title,
+        labels={'x': 'YoY Growth (%)', 'y': 'Manufacturer'},
+        text=growth_pct
+    )
+    fig.update_traces(texttemplate='%{text:.2f}%', textposition='outside')
+    fig.update_layout(
+        yaxis={'categoryorder':'total ascending'},
+        title_x=0.5,
+        uirevision='yoy'
+    )
+    return fig
 
 # --- Helper function to convert dataframe to CSV ---
-@st.cache_data
+@st.cache_data(max_entries=SELECTION_CACHE_ENTRIES)
 def convert_df_to_csv(df):
   # IMPORTANT: Cache the conversion to prevent computation on every rerun
-  return df.to_csv(index=False).encode('utf-8')
+  # PyArrow's multithreaded CSV writer emits UTF-8 bytes directly
+  # into an Arrow buffer, so no Python file object sits in between
+  buffer = pa.BufferOutputStream()
+  pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
+  return buffer.getvalue().to_pybytes()
 
 
 # --- Main Application ---
 st.title("🚗 Vehicle Registration Analysis Dashboard")
 st.markdown("An investor-focused view of vehicle registration trends, including YoY and QoQ growth.")
 
-data = load_and_prepare_data('.')
+dashboard_data = load_and_prepare_data('.')
+data = dashboard_data.df
 
 if data.empty:
     st.warning("Dashboard cannot be displayed because no data was loaded.")
@@ -106,17 +540,17 @@ else:
         selected_month_name = st.sidebar.selectbox("Select Month", month_list)
         selected_month_number = month_list.index(selected_month_name) + 1
         
-        all_years = sorted(data['year'].unique(), reverse=True)
+        all_years = dashboard_data.years[::-1]
         selected_year = st.sidebar.selectbox("Select Year", all_years)
         selected_years = (selected_year, selected_year)
 
     elif analysis_type == "Quarterly":
-        all_years = sorted(data['year'].unique(), reverse=True)
+        all_years = dashboard_data.years[::-1]
         selected_year = st.sidebar.selectbox("Select Year", all_years)
         selected_years = (selected_year, selected_year)
 
     else: # Overall Trend
-        min_year, max_year = int(data['year'].min()), int(data['year'].max())
+        min_year, max_year = dashboard_data.year_min, dashboard_data.year_max
         if min_year == max_year:
             st.sidebar.write(f"Data available for year: **{min_year}**")
             selected_years = (min_year, max_year)
@@ -128,32 +562,29 @@ else:
                 value=(min_year, max_year)
             )
 
-    vehicle_categories = sorted(data['Vehicle Category'].unique())
+    vehicle_categories = dashboard_data.categories_sorted
     selected_categories = st.sidebar.multiselect(
         "Select Vehicle Category",
         options=vehicle_categories,
         default=vehicle_categories
     )
 
-    manufacturers = sorted(data['Maker'].unique())
-    top_manufacturers = data.groupby('Maker')['Registrations'].sum().nlargest(10).index.tolist()
-    
     selected_manufacturers = st.sidebar.multiselect(
         "Select Manufacturer",
-        options=manufacturers,
-        default=top_manufacturers
+        options=dashboard_data.makers_sorted,
+        default=dashboard_data.top10_makers
     )
 
     # --- Filter Data based on selections ---
-    filtered_data = data[
-        (data['year'] >= selected_years[0]) &
-        (data['year'] <= selected_years[1]) &
-        (data['Vehicle Category'].isin(selected_categories)) &
-        (data['Maker'].isin(selected_manufacturers))
-    ]
-    
-    if analysis_type == "Monthly":
-        filtered_data = filtered_data[filtered_data['month'] == selected_month_number]
+    aggregates = compute_aggregates(
+        data,
+        dashboard_data.data_version,
+        tuple(selected_years),
+        tuple(selected_categories),
+        tuple(selected_manufacturers),
+        selected_month_number if analysis_type == "Monthly" else None
+    )
+    filtered_data, agg = aggregates['filtered'], aggregates['agg']
     
     if filtered_data.empty:
         st.warning("No data available for the selected filters.")
@@ -162,23 +593,14 @@ else:
         if analysis_type == "Monthly":
             st.subheader(f"Key Metrics for {selected_month_name} {selected_years[0]}")
             
-            current_registrations = filtered_data['Registrations'].sum()
-
-            prev_month_date = pd.to_datetime(f"{selected_years[0]}-{selected_month_number}-01") - pd.DateOffset(months=1)
-            prev_month_data = data[
-                (data['year'] == prev_month_date.year) & (data['month'] == prev_month_date.month) &
-                (data['Vehicle Category'].isin(selected_categories)) & (data['Maker'].isin(selected_manufacturers))
-            ]
-            prev_month_registrations = prev_month_data['Registrations'].sum()
-
-            prev_year_data = data[
-                (data['year'] == selected_years[0] - 1) & (data['month'] == selected_month_number) &
-                (data['Vehicle Category'].isin(selected_categories)) & (data['Maker'].isin(selected_manufacturers))
-            ]
-            prev_year_registrations = prev_year_data['Registrations'].sum()
-
-            mom_growth = ((current_registrations - prev_month_registrations) / prev_month_registrations) * 100 if prev_month_registrations else 0
-            yoy_growth = ((current_registrations - prev_year_registrations) / prev_year_registrations) * 100 if prev_year_registrations else 0
+            current_registrations, mom_growth, yoy_growth = compute_monthly_kpis(
+                dashboard_data,
+                dashboard_data.data_version,
+                selected_years[0],
+                selected_month_number,
+                tuple(selected_categories),
+                tuple(selected_manufacturers)
+            )
 
             col1, col2, col3 = st.columns(3)
             col1.metric("Total Registrations", f"{current_registrations:,.0f}")
@@ -188,9 +610,9 @@ else:
         elif analysis_type == "Quarterly":
             st.subheader(f"Quarterly Breakdown for {selected_years[0]}")
             
-            quarterly_summary = filtered_data.groupby('Quarter')['Registrations'].sum()
+            quarterly_summary = aggregates['quarter']
             
-            total_registrations = quarterly_summary.sum()
+            total_registrations = quarterly_summary.to_numpy().sum()
             best_quarter = quarterly_summary.idxmax() if not quarterly_summary.empty else "N/A"
             
             q1_regs = quarterly_summary.get('Q1', 0)
@@ -211,35 +633,37 @@ else:
                 st.subheader(f"Key Metrics for {selected_years[0]} - {selected_years[1]}")
             st.caption("QoQ and YoY growth are calculated for the most recent quarter in the selected range.")
 
-            total_registrations_for_range = filtered_data['Registrations'].sum()
-
-            latest_quarter_period = pd.Period(filtered_data['Date'].max(), freq='Q')
-            latest_quarter_df = filtered_data[pd.to_datetime(filtered_data['Date']).dt.to_period('Q') == latest_quarter_period]
-            current_quarter_registrations = latest_quarter_df['Registrations'].sum()
+            # Totals per calendar quarter, cached with the other aggregates; the
+            # range total is their sum rather than another pass over the rows
+            quarter_sums = aggregates['quarter_code']
+            total_registrations_for_range = quarter_sums.to_numpy().sum()
 
-            prev_quarter_period = latest_quarter_period - 1
-            prev_quarter_df = filtered_data[pd.to_datetime(filtered_data['Date']).dt.to_period('Q') == prev_quarter_period]
-            prev_quarter_registrations = prev_quarter_df['Registrations'].sum()
-
-            prev_year_quarter_period = latest_quarter_period - 4
-            prev_year_quarter_df = filtered_data[pd.to_datetime(filtered_data['Date']).dt.to_period('Q') == prev_year_quarter_period]
-            prev_year_quarter_registrations = prev_year_quarter_df['Registrations'].sum()
+            latest_quarter_code = quarter_sums.index.max()
+            current_quarter_registrations = quarter_sums.get(latest_quarter_code, 0)
+            prev_quarter_registrations = quarter_sums.get(latest_quarter_code - 1, 0)
+            prev_year_quarter_registrations = quarter_sums.get(latest_quarter_code - 4, 0)
+            # Formatted as e.g. 2025Q2 only for display
+            latest_quarter_label = f"{latest_quarter_code // 4}Q{latest_quarter_code % 4 + 1}"
 
             qoq_growth = ((current_quarter_registrations - prev_quarter_registrations) / prev_quarter_registrations) * 100 if prev_quarter_registrations else 0
             yoy_growth = ((current_quarter_registrations - prev_year_quarter_registrations) / prev_year_quarter_registrations) * 100 if prev_year_quarter_registrations else 0
 
             col1, col2, col3 = st.columns(3)
             col1.metric("Total Registrations", f"{total_registrations_for_range:,.0f}")
-            col2.metric(f"QoQ Growth ({str(latest_quarter_period)})", f"{qoq_growth:.2f}%", delta=f"{qoq_growth:.2f}%")
-            col3.metric(f"YoY Growth ({str(latest_quarter_period)})", f"{yoy_growth:.2f}%", delta=f"{yoy_growth:.2f}%")
+            col2.metric(f"QoQ Growth ({latest_quarter_label})", f"{qoq_growth:.2f}%", delta=f"{qoq_growth:.2f}%")
+            col3.metric(f"YoY Growth ({latest_quarter_label})", f"{yoy_growth:.2f}%", delta=f"{yoy_growth:.2f}%")
 
         # --- Download Button ---
         st.sidebar.markdown("---")
-        df_for_download = filtered_data.drop(columns=['Date', 'QuarterValue'], errors='ignore')
-        csv = convert_df_to_csv(df_for_download)
+        # Explicit column order: the loader's roll-up moves its group keys to the front
+        df_for_download = filtered_data[
+            ['Maker', 'year', 'month', 'Vehicle Category', 'Registrations', 'QuarterValue']
+        ].rename(columns={'QuarterValue': 'Quarter'})
+        df_for_download['Quarter'] = "Q" + df_for_download['Quarter'].astype(str)
+        csv_bytes = convert_df_to_csv(df_for_download)
         st.sidebar.download_button(
            label="Download Data as CSV",
-           data=csv,
+           data=csv_bytes,
            file_name='filtered_vehicle_data.csv',
            mime='text/csv',
         )
@@ -249,55 +673,31 @@ else:
         # --- Visualizations ---
         if analysis_type == "Quarterly":
             st.subheader(f"Registrations per Quarter for {selected_years[0]}")
-            quarterly_trends = filtered_data.groupby('Quarter')['Registrations'].sum().reset_index()
-            fig_trends = px.bar(
-                quarterly_trends,
-                x='Quarter',
-                y='Registrations',
-                title=f'Quarterly Registrations for {selected_years[0]}',
-                labels={'Registrations': 'Number of Registrations', 'Quarter': 'Quarter'}
+            quarterly_trends = aggregates['quarter'].reset_index()
+            fig_trends = build_trends_fig(
+                quarterly_trends, 'Quarter', f'Quarterly Registrations for {selected_years[0]}', 'Quarter'
             )
         else:
             st.subheader("Registration Trends")
-            monthly_trends = filtered_data.groupby('Date')['Registrations'].sum().reset_index()
-            fig_trends = px.bar(
-                monthly_trends,
-                x='Date',
-                y='Registrations',
-                title='Total Vehicle Registrations',
-                labels={'Registrations': 'Number of Registrations', 'Date': 'Month'}
-            )
+            monthly_trends = aggregates['monthly'].reset_index()
+            fig_trends = build_trends_fig(monthly_trends, 'Date', 'Total Vehicle Registrations', 'Month')
         
-        fig_trends.update_layout(title_x=0.5)
-        st.plotly_chart(fig_trends, use_container_width=True)
+        st.plotly_chart(fig_trends, use_container_width=True, config=PLOTLY_CONFIG)
 
         st.subheader("Manufacturer Performance")
         col1, col2 = st.columns(2)
 
         with col1:
             st.markdown("#### Market Share (by Registrations)")
-            manufacturer_share = filtered_data.groupby('Maker')['Registrations'].sum().reset_index()
-            fig_share = px.pie(
-                manufacturer_share.nlargest(10, 'Registrations'),
-                names='Maker',
-                values='Registrations',
-                title=f'Top 10 Manufacturers'
-            )
-            fig_share.update_layout(title_x=0.5)
-            st.plotly_chart(fig_share, use_container_width=True)
+            manufacturer_share = top_n(aggregates['maker'], 10).reset_index()
+            fig_share = build_share_fig(manufacturer_share)
+            st.plotly_chart(fig_share, use_container_width=True, config=PLOTLY_CONFIG)
 
         with col2:
             st.markdown("#### Category-wise Registrations")
-            category_share = filtered_data.groupby('Vehicle Category')['Registrations'].sum().reset_index()
-            fig_cat_share = px.bar(
-                category_share,
-                x='Vehicle Category',
-                y='Registrations',
-                title=f'Registrations by Vehicle Category',
-                color='Vehicle Category'
-            )
-            fig_cat_share.update_layout(title_x=0.5)
-            st.plotly_chart(fig_cat_share, use_container_width=True)
+            category_share = aggregates['category'].reset_index()
+            fig_cat_share = build_category_fig(category_share)
+            st.plotly_chart(fig_cat_share, use_container_width=True, config=PLOTLY_CONFIG)
             
         # --- Category-Specific Leaders ---
         st.markdown("---")
@@ -310,26 +710,15 @@ else:
             )
 
             if leader_category:
-                category_leader_data = filtered_data[filtered_data['Vehicle Category'] == leader_category]
+                category_leader_data = agg[agg.index.get_level_values('Vehicle Category') == leader_category]
 
                 if not category_leader_data.empty:
-                    leader_board = category_leader_data.groupby('Maker')['Registrations'].sum().sort_values(ascending=False).reset_index()
+                    leader_board = top_n(category_leader_data.groupby(level='Maker', observed=True, sort=False).sum(), 30).reset_index()
                     
                     if not leader_board.empty:
                         st.markdown(f"#### Manufacturer Rankings for {leader_category}")
-                        fig_leaderboard = px.bar(
-                            leader_board,
-                            x='Registrations',
-                            y='Maker',
-                            orientation='h',
-                            title=f'Rankings in {leader_category}',
-                            labels={'Registrations': 'Total Registrations', 'Maker': 'Manufacturer'}
-                        )
-                        fig_leaderboard.update_layout(
-                            yaxis={'categoryorder':'total ascending'},
-                            title_x=0.5
-                        )
-                        st.plotly_chart(fig_leaderboard, use_container_width=True)
+                        fig_leaderboard = build_leaderboard_fig(leader_board, leader_category)
+                        st.plotly_chart(fig_leaderboard, use_container_width=True, config=PLOTLY_CONFIG)
 
                     else:
                         st.info(f"No registration data for the selected manufacturers in the {leader_category} category.")
@@ -345,7 +734,7 @@ else:
         q_col1, q_col2 = st.columns(2)
         with q_col1:
             # --- UPDATE: Use years that have a PREVIOUS year in the data ---
-            available_years_for_yoy = [y for y in data['year'].unique() if y - 1 in data['year'].unique()]
+            available_years_for_yoy = dashboard_data.yoy_years
             if available_years_for_yoy:
                 yoy_year = st.selectbox("Select Year to Analyze", options=sorted(available_years_for_yoy, reverse=True))
             else:
@@ -362,24 +751,25 @@ else:
 
         if yoy_year:
             # --- UPDATE: Compare current year to PREVIOUS year ---
-            previous_year_data = data[(data['year'] == yoy_year - 1) & (data['Quarter'] == yoy_quarter)]
-            current_year_data = data[(data['year'] == yoy_year) & (data['Quarter'] == yoy_quarter)]
-
+            yoy_quarter_code = yoy_year * 4 + int(yoy_quarter[1]) - 1
+            quarter_codes = data['QCode'].to_numpy()
+            quarter_mask = (quarter_codes == yoy_quarter_code - 4) | (quarter_codes == yoy_quarter_code)
             # Filter by selected vehicle categories
-            previous_year_data = previous_year_data[previous_year_data['Vehicle Category'].isin(selected_categories)]
-            current_year_data = current_year_data[current_year_data['Vehicle Category'].isin(selected_categories)]
-
-            # Group by maker to get total registrations for the quarter
-            previous_sales = previous_year_data.groupby('Maker')['Registrations'].sum()
-            current_sales = current_year_data.groupby('Maker')['Registrations'].sum()
+            quarter_mask &= categorical_mask(data['Vehicle Category'], selected_categories)
 
-            # Combine the data
-            growth_df = pd.DataFrame({'PreviousSales': previous_sales, 'CurrentSales': current_sales}).fillna(0)
+            # One groupby over both years; unstacking lines up each maker's
+            # previous and current quarter totals (0 where a year is missing)
+            sales = data[quarter_mask].groupby(['year', 'Maker'], observed=True)['Registrations'].sum().unstack('year', fill_value=0)
+            growth_df = sales.reindex(columns=[yoy_year - 1, yoy_year], fill_value=0)
+            growth_df.columns = ['PreviousSales', 'CurrentSales']
             
-            # Calculate YoY Growth, handle division by zero
-            growth_df['YoY_Growth_%'] = (growth_df['CurrentSales'] - growth_df['PreviousSales']) / growth_df['PreviousSales'] * 100
-            growth_df.replace([float('inf'), -float('inf')], 0, inplace=True) # Replace infinite values from division by zero
-            growth_df.dropna(subset=['YoY_Growth_%'], inplace=True)
+            # Calculate YoY Growth in one NumPy pass; makers with no sales in the
+            # previous year get 0 rather than an infinite growth
+            current = growth_df['CurrentSales'].to_numpy('float64')
+            previous = growth_df['PreviousSales'].to_numpy('float64')
+            growth = np.zeros(len(growth_df))
+            np.divide(current - previous, previous, out=growth, where=previous > 0)
+            growth_df['YoY_Growth_%'] = growth * 100
 
 
             if yoy_view_type == "Top 5 Growth Companies":
@@ -390,21 +780,8 @@ else:
                 chart_title = f"Growth for Selected Companies: {yoy_quarter} {yoy_year} vs {yoy_year - 1}"
 
             if not final_df.empty:
-                fig_yoy_growth = px.bar(
-                    final_df,
-                    x='YoY_Growth_%',
-                    y='Maker',
-                    orientation='h',
-                    title=chart_title,
-                    labels={'YoY_Growth_%': 'YoY Growth (%)', 'Maker': 'Manufacturer'},
-                    text='YoY_Growth_%'
-                )
-                fig_yoy_growth.update_traces(texttemplate='%{text:.2f}%', textposition='outside')
-                fig_yoy_growth.update_layout(
-                    yaxis={'categoryorder':'total ascending'},
-                    title_x=0.5
-                )
-                st.plotly_chart(fig_yoy_growth, use_container_width=True)
+                fig_yoy_growth = build_yoy_growth_fig(final_df, chart_title)
+                st.plotly_chart(fig_yoy_growth, use_container_width=True, config=PLOTLY_CONFIG)
             else:
                 st.info("No data available to compare for the selected criteria.")
         else: